@@ -8,12 +8,24 @@
 #                                                   #
 # ------------------------------------------------- #
 
+import argparse
+import collections
 import imaplib
-import email
+import itertools
 import json
 import os
+import re
+import zlib
 from dotenv import load_dotenv
-from email.header import decode_header
+import email.policy
+from email.header import Header, decode_header
+from email.parser import BytesHeaderParser
+from email.utils import parseaddr
+
+try:
+    import orjson  # Optional, faster JSON parsing
+except ImportError:
+    orjson = None
 
 # ------------------------------- #
 #  Load Environment Variables     #
@@ -40,17 +52,29 @@ if not EMAIL or not PASSWORD:
 #  Load Non-Priority Senders      #
 # ------------------------------- #
 
-def load_non_priority_senders():
+def load_non_priority_senders(path='non_priority_senders.json'):
     """Load the list of non-priority senders from JSON file"""
     try:
-        with open('non_priority_senders.json', 'r') as f:
-            data = json.load(f)
-            return data['senders']
+        with open(path, 'rb') as f:
+            raw = f.read()
+        data = orjson.loads(raw) if orjson else json.loads(raw)
+        
+        # An empty FROM search would match every email, so never search for one
+        if any(not sender.strip() for sender in data['senders']):
+            print(f"⚠️  Warning: Ignoring empty sender entries in {path}")
+        
+        # All senders share one SEARCH command, which imaplib can only send as ASCII
+        for sender in data['senders']:
+            if not sender.isascii():
+                print(f"⚠️  Warning: Ignoring non-ASCII sender {sender!r} in {path}")
+        
+        # Gmail matches senders case-insensitively, so drop duplicate spellings
+        return sorted({sender.strip().lower() for sender in data['senders'] if sender.strip() and sender.isascii()})
     except FileNotFoundError:
-        print("❌ Error: non_priority_senders.json file not found")
+        print(f"❌ Error: {path} file not found")
         exit(1)
     except json.JSONDecodeError:
-        print("❌ Error: Invalid JSON in non_priority_senders.json")
+        print(f"❌ Error: Invalid JSON in {path}")
         exit(1)
 
 # ------------------------------- #
@@ -62,6 +86,14 @@ def decode_subject(subject):
     if subject is None:
         return "No Subject"
     
+    # Raw 8-bit headers parsed with the compat32 policy come back as Header objects
+    if isinstance(subject, Header):
+        subject = str(subject)
+    
+    # Plain subjects without encoded words need no decoding at all
+    if isinstance(subject, str) and '=?' not in subject:
+        return subject
+    
     try:
         decoded_parts = decode_header(subject)
         decoded_subject = ""
@@ -79,17 +111,120 @@ def decode_subject(subject):
     except Exception as e:
         return str(subject)
 
+# ------------------------------- #
+#  Compressed IMAP Connection     #
+# ------------------------------- #
+
+class CompressedIMAP4_SSL(imaplib.IMAP4_SSL):
+    """IMAP4_SSL connection that can switch to COMPRESS=DEFLATE (RFC 4978)"""
+    
+    compressor = None
+    decompressor = None
+    
+    # imaplib's own line limit is private, so fall back to its current value
+    max_line = getattr(imaplib, '_MAXLINE', 1000000)
+    
+    def enable_compression(self):
+        """Ask the server to deflate all further traffic in both directions"""
+        # Check what the framing below relies on before the server switches over
+        if not hasattr(getattr(self, 'file', None), 'read1'):
+            raise self.error("this Python's imaplib does not support compression")
+        
+        typ, data = self.xatom('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            raise self.error(f"COMPRESS failed: {data}")
+        
+        # RFC 4978 uses raw deflate streams, hence the negative window bits
+        self.compressor = zlib.compressobj(-1, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.inbuf = bytearray()
+        
+        # The server is already compressing, so a broken stream can only be
+        # recovered from by reconnecting (see open_gmail_connection)
+        try:
+            self.noop()
+        except (AttributeError, zlib.error) as e:
+            raise self.abort(f"compressed connection failed: {e}")
+    
+    def fill_inbuf(self):
+        """Read and inflate the next chunk from the socket"""
+        chunk = self.file.read1(16384)
+        if not chunk:
+            raise self.abort("socket error: EOF")
+        
+        try:
+            self.inbuf += self.decompressor.decompress(chunk)
+        except zlib.error as e:
+            raise self.abort(f"decompression error: {e}")
+    
+    def read(self, size):
+        """Read 'size' bytes from the server, inflating them if compressed"""
+        if self.decompressor is None:
+            return super().read(size)
+        
+        while len(self.inbuf) < size:
+            self.fill_inbuf()
+        
+        data = bytes(self.inbuf[:size])
+        del self.inbuf[:size]
+        return data
+    
+    def readline(self):
+        """Read a line from the server, inflating it if compressed"""
+        if self.decompressor is None:
+            return super().readline()
+        
+        while b'\n' not in self.inbuf:
+            if len(self.inbuf) > self.max_line:
+                raise self.error(f"got more than {self.max_line} bytes")
+            self.fill_inbuf()
+        
+        end = self.inbuf.index(b'\n') + 1
+        line = bytes(self.inbuf[:end])
+        del self.inbuf[:end]
+        return line
+    
+    def send(self, data):
+        """Send data to the server, deflating it if compressed"""
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        super().send(data)
+
 # ------------------------------- #
 #  Connect to Gmail               #
 # ------------------------------- #
 
+def open_gmail_connection(compress=True):
+    """Log in to Gmail and select the inbox, compressing traffic if possible"""
+    imap = CompressedIMAP4_SSL("imap.gmail.com")
+    imap.login(EMAIL, PASSWORD)
+    
+    # Gmail only lists extensions like COMPRESS and ESEARCH once logged in
+    typ, data = imap.capability()
+    if typ == 'OK' and data[-1]:
+        imap.capabilities = tuple(data[-1].decode().upper().split())
+    
+    if compress and 'COMPRESS=DEFLATE' in imap.capabilities:
+        try:
+            imap.enable_compression()
+        except imaplib.IMAP4.abort as e:
+            print(f"⚠️  Compressed connection failed, reconnecting without compression: {e}")
+            try:
+                imap.shutdown()
+            except Exception:
+                pass
+            return open_gmail_connection(compress=False)
+        except imaplib.IMAP4.error as e:
+            print(f"⚠️  Could not enable compression, continuing without it: {e}")
+    
+    imap.select("inbox")
+    return imap
+
 def connect_to_gmail():
     """Connect to Gmail using IMAP"""
     try:
         print("🔄 Connecting to Gmail...")
-        imap = imaplib.IMAP4_SSL("imap.gmail.com")
-        imap.login(EMAIL, PASSWORD)
-        imap.select("inbox")
+        imap = open_gmail_connection()
         print("✅ Connected to Gmail successfully")
         return imap
     except imaplib.IMAP4.error as e:
@@ -109,118 +244,278 @@ def connect_to_gmail():
 #                                                   #
 # ------------------------------------------------- #
 
+# ------------------------------- #
+#  Build Search Criteria          #
+# ------------------------------- #
+
+def quote_search_string(value):
+    """Quote a string for use inside an IMAP SEARCH command"""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def build_search_criteria(senders):
+    """Build a single SEARCH key matching emails from any of the senders"""
+    # IMAP's OR is binary, so fold right: OR FROM a OR FROM b FROM c
+    criteria = f'FROM {quote_search_string(senders[-1])}'
+    for sender in reversed(senders[:-1]):
+        criteria = f'OR FROM {quote_search_string(sender)} {criteria}'
+    return criteria
+
+def build_gmail_query(senders):
+    """Build a Gmail search query (for X-GM-RAW) matching any of the senders"""
+    return 'from:(' + ' OR '.join(senders) + ')'
+
+# ------------------------------- #
+#  Search Senders                 #
+# ------------------------------- #
+
+def search_senders(imap, senders, *options):
+    """Run one UID SEARCH matching any of the senders, with optional RETURN options"""
+    # Let Gmail evaluate the whole sender list with its own search index
+    if 'X-GM-EXT-1' in imap.capabilities:
+        try:
+            status, data = imap.uid('SEARCH', *options, 'X-GM-RAW', quote_search_string(build_gmail_query(senders)))
+            if status == 'OK':
+                return status, data
+        except (imaplib.IMAP4.error, UnicodeError) as e:
+            print(f"   ⚠️  Gmail search failed, falling back to standard IMAP search: {e}")
+    
+    # One UID SEARCH for all senders instead of one per sender
+    return imap.uid('SEARCH', *options, build_search_criteria(senders))
+
 # ------------------------------- #
 #  Find Emails from Senders       #
 # ------------------------------- #
 
 def find_emails_from_senders(imap, senders):
-    """Find all emails from the specified senders"""
-    emails_to_delete = []
+    """Find the UIDs of all emails from the specified senders, or None if the search failed"""
+    if not senders:
+        return []
     
     print(f"🔍 Searching for emails from {len(senders)} non-priority senders...")
     
-    for sender in senders:
-        print(f"   📧 Searching emails from: {sender}")
+    try:
+        status, data = search_senders(imap, senders)
+        
+        if status != 'OK':
+            print(f"   ❌ Search failed: {data}")
+            return None
+        
+        # A UID can only be STOREd once, so drop any repeats
+        uids = list(dict.fromkeys(data[0].split()))
+        print(f"   📊 Found {len(uids)} emails from non-priority senders")
+        return uids
+    
+    except Exception as e:
+        print(f"   ❌ Error searching for emails: {e}")
+        return None
+
+# ------------------------------- #
+#  Count Emails from Senders      #
+# ------------------------------- #
+
+def count_emails_from_senders(imap, senders):
+    """Count the emails from the specified senders without fetching them, or None if the search failed"""
+    # ESEARCH (RFC 4731) lets the server return just the count instead of every UID
+    if 'ESEARCH' not in imap.capabilities:
+        uids = find_emails_from_senders(imap, senders)
+        return None if uids is None else len(uids)
+    
+    if not senders:
+        return 0
+    
+    print(f"🔍 Counting emails from {len(senders)} non-priority senders...")
+    
+    try:
+        status, data = search_senders(imap, senders, 'RETURN (COUNT)')
+        
+        if status != 'OK':
+            print(f"   ❌ Search failed: {data}")
+            return None
+        
+        _, data = imap.response('ESEARCH')
+        match = re.search(rb'COUNT (\d+)', data[0] or b'')
+        return int(match.group(1)) if match else 0
+    
+    except Exception as e:
+        print(f"   ❌ Error counting emails: {e}")
+        return None
+
+# ------------------------------- #
+#  Fetch Email Headers            #
+# ------------------------------- #
+
+# Stops at the end of the headers instead of parsing a full MIME tree; the
+# default policy returns every header as a decoded str, even raw 8-bit ones
+header_parser = BytesHeaderParser(policy=email.policy.default)
+
+def batch_fetch_headers(imap, uids, chunk=100):
+    """Yield (uid, raw headers) for the given UIDs, fetching `chunk` UIDs per FETCH"""
+    uids = iter(uids)
+    
+    while True:
+        batch = list(itertools.islice(uids, chunk))
+        if not batch:
+            return
+        
+        try:
+            # BODY.PEEK fetches only the headers and leaves the \Seen flag alone
+            status, msg_data = imap.uid('FETCH', b",".join(batch), '(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])')
+        except imaplib.IMAP4.abort as e:
+            # The connection is gone, no later batch can succeed either
+            print(f"   ❌ Connection lost while fetching headers: {e}")
+            return
+        except imaplib.IMAP4.error as e:
+            print(f"   ⚠️  Error fetching {len(batch)} messages: {e}")
+            continue
+        
+        if status != 'OK':
+            print(f"   ⚠️  Error fetching {len(batch)} messages: {msg_data}")
+            continue
+        
+        for part in msg_data:
+            # Each message comes back as (b'<seq> (UID <uid> BODY[...] {n}', headers)
+            if isinstance(part, tuple):
+                match = re.search(rb'UID (\d+)', part[0])
+                if match:
+                    yield match.group(1), part[1]
+
+def fetch_email_headers(imap, uids, senders, per_sender=5):
+    """Count the given emails per sender index, keeping headers of the first few for preview"""
+    emails = {}
+    counts = collections.Counter()
+    seen = set()
+    
+    sender_index = {sender: i for i, sender in enumerate(senders)}
+    
+    for uid, headers in batch_fetch_headers(imap, uids):
+        if uid in seen:
+            continue
+        seen.add(uid)
         
         try:
-            # Search for emails from this sender
-            search_criteria = f'FROM "{sender}"'
-            status, messages = imap.search(None, search_criteria)
+            email_message = header_parser.parsebytes(headers)
             
-            if status == 'OK':
-                message_ids = messages[0].split()
-                
-                for msg_id in message_ids:
-                    try:
-                        # Fetch the email
-                        status, msg_data = imap.fetch(msg_id, '(RFC822)')
-                        
-                        if status == 'OK':
-                            email_body = msg_data[0][1]
-                            email_message = email.message_from_bytes(email_body)
-                            
-                            subject = decode_subject(email_message["Subject"])
-                            date = email_message["Date"]
-                            from_addr = email_message["From"]
-                            
-                            emails_to_delete.append({
-                                'id': msg_id.decode(),
-                                'subject': subject,
-                                'from': from_addr,
-                                'date': date,
-                                'sender': sender
-                            })
-                    
-                    except Exception as e:
-                        print(f"   ⚠️  Error processing message {msg_id}: {e}")
-                        continue
-                        
-                print(f"   📊 Found {len([e for e in emails_to_delete if e['sender'] == sender])} emails from {sender}")
+            from_addr = str(email_message["From"] or "")
+            sender = match_sender(from_addr, senders, sender_index)
+            
+            counts[sender] += 1
+            
+            # Only the emails that will be shown need to be kept around
+            if counts[sender] <= per_sender:
+                emails[uid] = {
+                    'subject': email_message["Subject"],
+                    'from': from_addr,
+                    'date': email_message["Date"],
+                    'sender': sender
+                }
         
         except Exception as e:
-            print(f"   ❌ Error searching for {sender}: {e}")
+            print(f"   ⚠️  Error processing message {uid}: {e}")
             continue
     
-    return emails_to_delete
+    return emails, counts
+
+def match_sender(from_addr, senders, sender_index):
+    """Return the index of the sender that matched the From header, or len(senders) if none did"""
+    # Most From headers carry exactly one of the configured addresses
+    index = sender_index.get(parseaddr(from_addr)[1].lower())
+    if index is not None:
+        return index
+    
+    # IMAP FROM is a case-insensitive substring match, mirror it here
+    from_lower = from_addr.lower()
+    for index, sender in enumerate(senders):
+        if sender in from_lower:
+            return index
+    return len(senders)
 
 # ------------------------------- #
 #  Display Email Summary          #
 # ------------------------------- #
 
-def display_email_summary(emails):
+def display_email_summary(emails, counts, senders):
     """Display summary of emails found"""
-    if not emails:
+    if not counts:
         print("✅ No emails found from non-priority senders!")
         return False
     
-    print(f"\n📋 Found {len(emails)} emails from non-priority senders:")
+    print(f"\n📋 Found {sum(counts.values())} emails from non-priority senders:")
     print("=" * 80)
     
-    # Group by sender
-    by_sender = {}
-    for email_info in emails:
-        sender = email_info['sender']
-        if sender not in by_sender:
-            by_sender[sender] = []
-        by_sender[sender].append(email_info)
+    # Group by sender index, the extra last slot holds emails no sender matched
+    by_sender = [[] for _ in range(len(senders) + 1)]
+    for email_info in emails.values():
+        by_sender[email_info['sender']].append(email_info)
     
-    for sender, sender_emails in by_sender.items():
-        print(f"\n📧 {sender} ({len(sender_emails)} emails):")
+    for index, sender in enumerate(senders + ["other senders"]):
+        count = counts[index]
+        if not count:
+            continue
+        
+        sender_emails = by_sender[index]
+        
+        print(f"\n📧 {sender} ({count} emails):")
         print("-" * 60)
         
-        for i, email_info in enumerate(sender_emails[:5], 1):  # Show max 5 per sender
-            subject = email_info['subject'][:60] + "..." if len(email_info['subject']) > 60 else email_info['subject']
+        for i, email_info in enumerate(sender_emails, 1):  # Already capped per sender
+            subject = decode_subject(email_info['subject'])
+            subject = subject[:60] + "..." if len(subject) > 60 else subject
             print(f"   {i}. {subject}")
         
-        if len(sender_emails) > 5:
-            print(f"   ... and {len(sender_emails) - 5} more emails")
+        if sender_emails and count > len(sender_emails):
+            print(f"   ... and {count - len(sender_emails)} more emails")
     
     print("=" * 80)
     return True
 
+# ------------------------------- #
+#  Build Sequence Set             #
+# ------------------------------- #
+
+def to_sequence_set(uids):
+    """Compress UIDs into an IMAP sequence set, e.g. [1,2,3,5,7,8] -> 1:3,5,7:8"""
+    numbers = sorted({int(uid) for uid in uids})
+    ranges = []
+    
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    
+    return ",".join(f"{start}:{end}" if start != end else f"{start}" for start, end in ranges)
+
 # ------------------------------- #
 #  Delete Emails                  #
 # ------------------------------- #
 
-def delete_emails(imap, emails):
-    """Delete the specified emails"""
-    print(f"\n🗑️  Deleting {len(emails)} emails...")
+def delete_emails(imap, uids, chunk=500):
+    """Delete the emails with the specified UIDs"""
+    print(f"\n🗑️  Deleting {len(uids)} emails...")
     
     deleted_count = 0
     failed_count = 0
     
-    for email_info in emails:
+    uid_iter = iter(uids)
+    
+    while True:
+        batch = list(itertools.islice(uid_iter, chunk))
+        if not batch:
+            break
+        
         try:
-            # Mark email as deleted
-            imap.store(email_info['id'], '+FLAGS', '\\Deleted')
-            deleted_count += 1
+            # Mark the whole batch as deleted with a single STORE
+            status, data = imap.uid('STORE', to_sequence_set(batch), '+FLAGS', '(\\Deleted)')
             
-            if deleted_count % 10 == 0:  # Progress update every 10 deletions
-                print(f"   📊 Deleted {deleted_count}/{len(emails)} emails...")
-                
+            if status != 'OK':
+                raise imaplib.IMAP4.error(data)
+            
+            deleted_count += len(batch)
+            print(f"   📊 Deleted {deleted_count}/{len(uids)} emails...")
+        
         except Exception as e:
-            print(f"   ❌ Failed to delete email '{email_info['subject'][:30]}...': {e}")
-            failed_count += 1
+            print(f"   ❌ Failed to delete {len(batch)} emails: {e}")
+            failed_count += len(batch)
     
     # Expunge to permanently delete
     try:
@@ -239,29 +534,98 @@ def delete_emails(imap, emails):
 #                                                   #
 # ------------------------------------------------- #
 
+# ------------------------------- #
+#  Parse Arguments                #
+# ------------------------------- #
+
+def non_negative_int(value):
+    """Argparse type for integers that must be 0 or more"""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or more, got {value}")
+    return number
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Delete emails from non-priority senders in your Gmail inbox")
+    parser.add_argument('--yes', action='store_true',
+                        help="delete without asking for confirmation")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="report how many emails would be deleted without deleting them")
+    parser.add_argument('--preview', type=non_negative_int, metavar='N',
+                        help="show up to N subjects per sender (default: 5 when asking for confirmation, 0 otherwise)")
+    parser.add_argument('--senders-file', default='non_priority_senders.json', metavar='PATH',
+                        help="JSON file listing the non-priority senders (default: %(default)s)")
+    return parser.parse_args()
+
 def main():
     """Main function to orchestrate the email deletion process"""
+    args = parse_args()
+    
+    # Subjects are only worth fetching when someone is going to read them
+    preview = args.preview
+    if preview is None:
+        preview = 0 if args.yes or args.dry_run else 5
+    
     print("🚀 Starting Non-Priority Email Deletion Script")
     print("=" * 50)
     
     # Load non-priority senders
-    senders = load_non_priority_senders()
+    senders = load_non_priority_senders(args.senders_file)
     print(f"📝 Loaded {len(senders)} non-priority senders from JSON")
     
     # Connect to Gmail
     imap = connect_to_gmail()
     
     try:
+        # Without a preview a dry run only needs the count, no UIDs or headers
+        if args.dry_run and not preview:
+            count = count_emails_from_senders(imap, senders)
+            
+            if count is None:
+                print("❌ Error: Could not count non-priority emails")
+                exit(1)
+            
+            print(f"\n🧪 Dry run: {count} emails would be deleted")
+            return
+        
         # Find emails from non-priority senders
         emails_to_delete = find_emails_from_senders(imap, senders)
         
+        # A failed search says nothing about the inbox, so don't report it as empty
+        if emails_to_delete is None:
+            print("❌ Error: Could not search for non-priority emails, nothing was deleted")
+            exit(1)
+        
+        if not emails_to_delete:
+            print("✅ No emails found from non-priority senders!")
+            return
+        
         # Display summary
-        if not display_email_summary(emails_to_delete):
+        if preview:
+            emails, counts = fetch_email_headers(imap, emails_to_delete, senders, per_sender=preview)
+            
+            # Never ask to delete emails the user could not be shown
+            if not counts:
+                print(f"❌ Could not preview any of the {len(emails_to_delete)} matching emails, nothing was deleted")
+                return
+            
+            display_email_summary(emails, counts, senders)
+            
+            previewed = sum(counts.values())
+            if previewed < len(emails_to_delete):
+                print(f"⚠️  Only {previewed} of the {len(emails_to_delete)} matching emails could be previewed")
+        
+        if args.dry_run:
+            print(f"\n🧪 Dry run: {len(emails_to_delete)} emails would be deleted")
             return
         
         # Ask for confirmation
-        print(f"\n❓ Do you want to delete these {len(emails_to_delete)} emails? (y/N): ", end="")
-        confirmation = input().strip().lower()
+        if args.yes:
+            confirmation = 'yes'
+        else:
+            print(f"\n❓ Do you want to delete these {len(emails_to_delete)} emails? (y/N): ", end="")
+            confirmation = input().strip().lower()
         
         if confirmation in ['y', 'yes']:
             delete_emails(imap, emails_to_delete)